@@ -5,6 +5,7 @@ value network.
 """
 from multiprocessing import connection, Pipe
 from threading import Thread
+from time import time
 
 import numpy as np
 
@@ -19,6 +20,8 @@ class ChessModelAPI:
     Attributes:
         :ivar ChessModel agent_model: ChessModel to use to make predictions.
         :ivar list(Connection): list of pipe connections to listen for states on and return predictions on.
+        :ivar Thread prediction_worker: thread making the predictions
+        :ivar bool running: false once close has been called
     """
     # noinspection PyUnusedLocal
     def __init__(self, agent_model):  # ChessModel
@@ -28,15 +31,29 @@ class ChessModelAPI:
         """
         self.agent_model = agent_model
         self.pipes = []
+        self.prediction_worker = None
+        self.running = False
 
     def start(self):
         """
         Starts a thread to listen on the pipe and make predictions
         :return:
         """
-        prediction_worker = Thread(target=self._predict_batch_worker, name="prediction_worker")
-        prediction_worker.daemon = True
-        prediction_worker.start()
+        self.running = True
+        self.prediction_worker = Thread(target=self._predict_batch_worker, name="prediction_worker")
+        self.prediction_worker.daemon = True
+        self.prediction_worker.start()
+
+    def close(self):
+        """
+        Stops the thread listening on the pipes and closes this end of each of them
+        """
+        self.running = False
+        if self.prediction_worker is not None:
+            self.prediction_worker.join()
+        for pipe in self.pipes:
+            pipe.close()
+        self.pipes = []
 
     def create_pipe(self):
         """
@@ -52,18 +69,32 @@ class ChessModelAPI:
         """
         Thread worker which listens on each pipe in self.pipes for an observation, and then outputs
         the predictions for the policy and value networks when the observations come in. Repeats.
+        Once a first observation arrives, keeps collecting more for up to api_batch_timeout seconds
+        (or until api_max_batch_size of them, or one from every pipe, are in), so they can all be predicted
+        in a single batch.
         """
-        while True:
+        mc = self.agent_model.config.model
+        # reused for every batch, rather than stacking a new array out of the received observations each time
+        data = np.empty((mc.api_max_batch_size, mc.input_depth, 8, 8), dtype=np.float32)
+        while self.running:
             ready = connection.wait(self.pipes,timeout=0.001)
             if not ready:
                 continue
-            data, result_pipes = [], []
-            for pipe in ready:
-                while pipe.poll():
-                    data.append(pipe.recv())
-                    result_pipes.append(pipe)
+            result_pipes = []
+            # each pipe waits on its prediction before sending another observation, so once every pipe has
+            # sent one there is nothing more to wait for
+            batch_size = min(mc.api_max_batch_size, len(self.pipes))
+            deadline = time() + mc.api_batch_timeout
+            while True:
+                for pipe in ready:
+                    while len(result_pipes) < mc.api_max_batch_size and pipe.poll():
+                        data[len(result_pipes)] = pipe.recv()
+                        result_pipes.append(pipe)
+                remaining = deadline - time()
+                if len(result_pipes) >= batch_size or remaining <= 0:
+                    break
+                ready = connection.wait(self.pipes, timeout=remaining)
 
-            data = np.asarray(data, dtype=np.float32)
-            policy_ary, value_ary = self.agent_model.model.predict_on_batch(data)
+            policy_ary, value_ary = self.agent_model.inference_model.predict_on_batch(data[:len(result_pipes)])
             for pipe, p, v in zip(result_pipes, policy_ary, value_ary):
                 pipe.send((p, float(v)))
@@ -6,23 +6,101 @@ import ftplib
 import hashlib
 import json
 import os
+from contextlib import contextmanager
+from functools import wraps
 from logging import getLogger
 
-from keras.engine.topology import Input
+from keras.engine.topology import Input, InputLayer, Layer
 from keras.engine.training import Model
 from keras.layers.convolutional import Conv2D
-from keras.layers.core import Activation, Dense, Flatten
+from keras.layers.core import Activation, Dense, Flatten, Permute
 from keras.layers.merge import Add
 from keras.layers.normalization import BatchNormalization
 from keras.regularizers import l2
 
 from chess_zero.agent.api_chess import ChessModelAPI
 from chess_zero.config import Config
+from chess_zero.lib.data_helper import read_input_planes
+from chess_zero.lib.keras_util import fuse_batchnorm, cast_model, prune_inner_channels, to_channels_last
+from chess_zero.lib.tf_util import build_trt_int8_graph, frozen_graph_def, write_frozen_model, isolated_session, \
+    new_session, session_scope, FrozenGraphPredictor, FROZEN_INPUT_NAME, FROZEN_OUTPUT_NAMES
 
 # noinspection PyPep8Naming
 
 logger = getLogger(__name__)
 
+FTP_BLOCK_SIZE = 1 << 20  # the ftplib default of 8 KB leaves high latency links mostly idle
+
+
+class FakeQuantConv2D(Conv2D):
+    """
+    Conv2D which convolves with its kernel fake quantized to 8 bits per output channel, for quantization
+    aware training. Gradients pass straight through the quantization, so training learns weights which hold
+    up once the layer is really run in INT8. Its weights are the same as a Conv2D's, so either one can be
+    loaded into the other, and fuse_batchnorm swaps it back to a plain Conv2D for inference.
+    """
+    def call(self, inputs):
+        import tensorflow as tf
+        import keras.backend as k
+
+        # clamped, since a channel whose weights have all decayed to 0 would otherwise get an empty range
+        max_abs = k.stop_gradient(k.maximum(k.max(k.abs(self.kernel), axis=(0, 1, 2)), k.epsilon()))
+        kernel = tf.fake_quant_with_min_max_vars_per_channel(self.kernel, -max_abs, max_abs, num_bits=8,
+                                                             narrow_range=True)
+        outputs = k.conv2d(inputs, kernel, strides=self.strides, padding=self.padding,
+                           data_format=self.data_format, dilation_rate=self.dilation_rate)
+        if self.use_bias:
+            outputs = k.bias_add(outputs, self.bias, data_format=self.data_format)
+        if self.activation is not None:
+            return self.activation(outputs)
+        return outputs
+
+
+class SliceChannels(Layer):
+    """
+    Takes a range of the channels of a feature map, for splitting the shared head conv into the policy and
+    value heads. Unlike a Lambda, it saves as plain config which loads anywhere.
+
+    Attributes:
+        :ivar int start: first channel to keep
+        :ivar int stop: channel to stop before
+        :ivar int axis: channel axis, 1 for channels_first and -1 for channels_last
+    """
+    def __init__(self, start, stop, axis=1, **kwargs):
+        super().__init__(**kwargs)
+        self.start = start
+        self.stop = stop
+        self.axis = axis
+
+    def call(self, inputs):
+        if self.axis == 1:
+            return inputs[:, self.start:self.stop]
+        return inputs[..., self.start:self.stop]
+
+    def compute_output_shape(self, input_shape):
+        output_shape = list(input_shape)
+        output_shape[self.axis] = self.stop - self.start
+        return tuple(output_shape)
+
+    def get_config(self):
+        config = {"start": self.start, "stop": self.stop, "axis": self.axis}
+        config.update(super().get_config())
+        return config
+
+
+CUSTOM_OBJECTS = {"FakeQuantConv2D": FakeQuantConv2D, "SliceChannels": SliceChannels}  # layers Model.from_config needs to be told about
+
+
+def _in_own_session(method):
+    """
+    Decorates a ChessModel method so that it runs in the model's own graph and session, if it has them.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with session_scope(self.session):
+            return method(self, *args, **kwargs)
+    return wrapper
+
 
 class ChessModel:
     """
@@ -31,15 +109,29 @@ class ChessModel:
 
     Attributes:
         :ivar Config config: configuration to use
-        :ivar Model model: the Keras model to use for predictions
+        :ivar Model model: the Keras model to train and save
+        :ivar FrozenGraphPredictor inference_model: runs a frozen copy of model optimized for making predictions,
+            in a graph and session of its own. Used by the api.
         :ivar digest: basically just a hash of the file containing the weights being used by this model
+        :ivar str weight_path: path of the file the weights were last loaded from or saved to
         :ivar ChessModelAPI api: the api to use to listen for and then return this models predictions (on a pipe).
+        :ivar tf.Session session: graph and session model lives in, if not keras' main ones
     """
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, isolated=False):
+        """
+        :param Config config: configuration to use
+        :param bool isolated: build the model in a graph and session of its own, which close frees, rather
+            than in keras' main graph, whose variables are never freed
+        """
+        import tensorflow as tf
+
         self.config = config
         self.model = None  # type: Model
+        self.inference_model = None
         self.digest = None
+        self.weight_path = None
         self.api = None
+        self.session = new_session(tf.Graph()) if isolated else None
 
     def get_pipes(self, num = 1):
         """
@@ -50,76 +142,268 @@ class ChessModel:
         :return str(Connection): a list of all connections to the pipes that were created
         """
         if self.api is None:
+            self._build_inference_model()
             self.api = ChessModelAPI(self)
             self.api.start()
         return [self.api.create_pipe() for _ in range(num)]
 
-    def build(self):
+    def close_pipes(self):
+        """
+        Stops making predictions on the pipes created by get_pipes, closing the session of the model used
+        for them.
+        """
+        if self.api is not None:
+            self.api.close()
+            self.api = None
+            self.inference_model.close()
+            self.inference_model = None
+
+    def close(self):
+        """
+        Stops making predictions and, if the model was built isolated, closes its session, freeing its
+        variables. The model can't be used afterwards.
+        """
+        self.close_pipes()
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    @_in_own_session
+    def build(self, inner_filter_num=None):
         """
         Builds the full Keras model and stores it in self.model.
+
+        :param int inner_filter_num: number of channels of the first conv of each residual block, less than
+            cnn_filter_num if the blocks have been pruned. Defaults to cnn_filter_num.
         """
         mc = self.config.model
+        inner_filter_num = inner_filter_num or mc.cnn_filter_num
+        channel_axis = 1 if mc.data_format == "channels_first" else -1
+        reg = l2(mc.l2_reg) if mc.training else None  # only the loss uses it, so skip it when just predicting
         in_x = x = Input((18, 8, 8))
+        if mc.data_format == "channels_last":
+            x = Permute((2, 3, 1), name="input_transpose")(x)
 
-        # (batch, channels, height, width)
+        # (batch, channels, height, width), or (batch, height, width, channels) for channels_last
         x = Conv2D(filters=mc.cnn_filter_num, kernel_size=mc.cnn_first_filter_size, padding="same",
-                   data_format="channels_first", use_bias=False, kernel_regularizer=l2(mc.l2_reg),
+                   data_format=mc.data_format, use_bias=False, kernel_regularizer=reg,
                    name="input_conv-"+str(mc.cnn_first_filter_size)+"-"+str(mc.cnn_filter_num))(x)
-        x = BatchNormalization(axis=1, name="input_batchnorm")(x)
+        x = BatchNormalization(axis=channel_axis, name="input_batchnorm")(x)
         x = Activation("relu", name="input_relu")(x)
 
         for i in range(mc.res_layer_num):
-            x = self._build_residual_block(x, i + 1)
+            x = self._build_residual_block(x, i + 1, reg, inner_filter_num)
 
         res_out = x
-        
+
+        # one conv for both heads, the first 2 channels go to the policy output and the other 4 to the value output
+        x = Conv2D(filters=6, kernel_size=1, data_format=mc.data_format, use_bias=False, kernel_regularizer=reg,
+                    name="head_conv-1-6")(res_out)
+        x = BatchNormalization(axis=channel_axis, name="head_batchnorm")(x)
+        head_out = Activation("relu", name="head_relu")(x)
+
         # for policy output
-        x = Conv2D(filters=2, kernel_size=1, data_format="channels_first", use_bias=False, kernel_regularizer=l2(mc.l2_reg),
-                    name="policy_conv-1-2")(res_out)
-        x = BatchNormalization(axis=1, name="policy_batchnorm")(x)
-        x = Activation("relu", name="policy_relu")(x)
+        x = SliceChannels(0, 2, axis=channel_axis, name="policy_slice")(head_out)
         x = Flatten(name="policy_flatten")(x)
         # no output for 'pass'
-        policy_out = Dense(self.config.n_labels, kernel_regularizer=l2(mc.l2_reg), activation="softmax", name="policy_out")(x)
+        policy_out = Dense(self.config.n_labels, kernel_regularizer=reg, activation="softmax", name="policy_out")(x)
 
         # for value output
-        x = Conv2D(filters=4, kernel_size=1, data_format="channels_first", use_bias=False, kernel_regularizer=l2(mc.l2_reg),
-                    name="value_conv-1-4")(res_out)
-        x = BatchNormalization(axis=1, name="value_batchnorm")(x)
-        x = Activation("relu",name="value_relu")(x)
+        x = SliceChannels(2, 6, axis=channel_axis, name="value_slice")(head_out)
         x = Flatten(name="value_flatten")(x)
-        x = Dense(mc.value_fc_size, kernel_regularizer=l2(mc.l2_reg), activation="relu", name="value_dense")(x)
-        value_out = Dense(1, kernel_regularizer=l2(mc.l2_reg), activation="tanh", name="value_out")(x)
+        x = Dense(mc.value_fc_size, kernel_regularizer=reg, activation="relu", name="value_dense")(x)
+        value_out = Dense(1, kernel_regularizer=reg, activation="tanh", name="value_out")(x)
 
         self.model = Model(in_x, [policy_out, value_out], name="chess_model")
 
-    def _build_residual_block(self, x, index):
+    def _build_residual_block(self, x, index, reg, inner_filter_num):
         mc = self.config.model
+        channel_axis = 1 if mc.data_format == "channels_first" else -1
         in_x = x
         res_name = "res"+str(index)
-        x = Conv2D(filters=mc.cnn_filter_num, kernel_size=mc.cnn_filter_size, padding="same",
-                   data_format="channels_first", use_bias=False, kernel_regularizer=l2(mc.l2_reg), 
-                   name=res_name+"_conv1-"+str(mc.cnn_filter_size)+"-"+str(mc.cnn_filter_num))(x)
-        x = BatchNormalization(axis=1, name=res_name+"_batchnorm1")(x)
+        conv = FakeQuantConv2D if mc.quantize_residual else Conv2D
+        x = conv(filters=inner_filter_num, kernel_size=mc.cnn_filter_size, padding="same",
+                 data_format=mc.data_format, use_bias=False, kernel_regularizer=reg, 
+                 name=res_name+"_conv1-"+str(mc.cnn_filter_size)+"-"+str(inner_filter_num))(x)
+        x = BatchNormalization(axis=channel_axis, name=res_name+"_batchnorm1")(x)
         x = Activation("relu",name=res_name+"_relu1")(x)
-        x = Conv2D(filters=mc.cnn_filter_num, kernel_size=mc.cnn_filter_size, padding="same",
-                   data_format="channels_first", use_bias=False, kernel_regularizer=l2(mc.l2_reg), 
-                   name=res_name+"_conv2-"+str(mc.cnn_filter_size)+"-"+str(mc.cnn_filter_num))(x)
-        x = BatchNormalization(axis=1, name="res"+str(index)+"_batchnorm2")(x)
+        x = conv(filters=mc.cnn_filter_num, kernel_size=mc.cnn_filter_size, padding="same",
+                 data_format=mc.data_format, use_bias=False, kernel_regularizer=reg, 
+                 name=res_name+"_conv2-"+str(mc.cnn_filter_size)+"-"+str(mc.cnn_filter_num))(x)
+        x = BatchNormalization(axis=channel_axis, name="res"+str(index)+"_batchnorm2")(x)
         x = Add(name=res_name+"_add")([in_x, x])
         x = Activation("relu", name=res_name+"_relu2")(x)
         return x
 
+    @_in_own_session
+    def prune_residual_blocks(self, keep_ratio):
+        """
+        Replaces self.model with a copy in which the first conv of each residual block only keeps the given
+        fraction of cnn_filter_num channels, those contributing the most to its output. The result is a
+        smaller dense model, which should then be fine-tuned. Does nothing if the blocks are already at most
+        that wide, so a pruned model is never pruned again.
+
+        :param float keep_ratio: fraction of cnn_filter_num channels to keep, from 0 to 1
+        """
+        inner_filter_num = max(1, int(round(self.config.model.cnn_filter_num * keep_ratio)))
+        current = self._inner_filter_num([layer.get_config() for layer in self.model.layers])
+        if current is None or current <= inner_filter_num:
+            return
+        logger.debug(f"pruning residual blocks from {current} to {inner_filter_num} channels")
+        self.model = prune_inner_channels(self.model, inner_filter_num)
+
+    @staticmethod
+    def _inner_filter_num(layer_configs):
+        """
+        :param list(dict) layer_configs: configs of the layers of a model
+        :return int: number of channels of the first conv of the model's residual blocks, None if it has none
+        """
+        for config in layer_configs:
+            if config["name"].startswith("res1_conv1-"):
+                return config["filters"]
+        return None
+
+    @_in_own_session
+    def _build_inference_model(self):
+        """
+        Builds self.inference_model from the current weights of self.model. It is built from a copy of
+        self.model in a graph of its own, which is thrown away once the result is frozen, so reloading the
+        weights does not keep adding copies of the model to the main graph. Training is over at this point,
+        so each batch normalization is folded into the convolution before it, and if configured the
+        layout is switched to channels_last, the weights are cast to float16 or the whole model is
+        compiled to a TensorRT INT8 engine. If a frozen graph or TensorRT engine of the loaded weights was
+        saved before, that is used instead of building anything.
+        """
+        mc = self.config.model
+        if mc.trt_int8_inference:
+            resources = self.config.resource
+            # the engine is only valid for the layout and largest batch it was built for
+            key = f"{self.digest}_{mc.inference_data_format}_{mc.api_max_batch_size}"
+            engine_path = resources.model_trt_int8_path_tmpl % key if self.digest else None
+            if engine_path and os.path.exists(engine_path):
+                logger.debug(f"loading TensorRT graph from {engine_path}")
+                self.inference_model = FrozenGraphPredictor.load(engine_path)
+                return
+            self.inference_model = self.export_trt(engine_path, resources.play_data_dir)
+            if self.inference_model is not None:
+                return
+        frozen_path = self.frozen_path(self.weight_path) if self.weight_path else None
+        if mc.frozen_inference and frozen_path and os.path.exists(frozen_path) \
+                and os.path.getmtime(frozen_path) >= os.path.getmtime(self.weight_path):
+            logger.debug(f"loading frozen model from {frozen_path}")
+            self.inference_model = FrozenGraphPredictor.load(frozen_path)
+            return
+        with self._isolated_copy() as copy:
+            graph_def = frozen_graph_def(copy._prediction_model())
+        self.inference_model = FrozenGraphPredictor(graph_def, FROZEN_INPUT_NAME, FROZEN_OUTPUT_NAMES)
+
+    def _prediction_model(self):
+        """
+        :return Model: copy of self.model to make predictions with, as configured by the model config
+        """
+        model = self._fused_model()
+        if self.config.model.fp16_inference:
+            # the output layers sum over thousands of inputs, and float16 is too coarse for those sums
+            model = cast_model(model, "float16", keep_float32=("value_dense", "policy_out", "value_out"))
+        return model
+
+    def _fused_model(self):
+        """
+        :return Model: copy of self.model with its batch normalizations folded away, in the data format
+            configured for inference
+        """
+        model = fuse_batchnorm(self.model)
+        if self.config.model.inference_data_format == "channels_last":
+            model = to_channels_last(model)
+        return model
+
+    @contextmanager
+    def _isolated_copy(self):
+        """
+        Copies self.model into a graph and session of their own for the duration of the block, so that the
+        models derived from it for export do not keep adding ops to the graph being trained.
+
+        :return ChessModel: model holding the copy
+        """
+        model_config = self.model.get_config()
+        weights = self.model.get_weights()
+        with isolated_session():
+            copy = ChessModel(self.config)
+            copy.model = Model.from_config(model_config, custom_objects=CUSTOM_OBJECTS)
+            copy.model.set_weights(weights)
+            yield copy
+
+    def _write_frozen_model(self, path):
+        """
+        Writes the prediction model to path as a frozen graph.
+
+        :param str path: path to write the frozen graph to
+        """
+        with self._isolated_copy() as copy:
+            write_frozen_model(copy._prediction_model(), path)
+
+    @_in_own_session
+    def export_trt(self, engine_path, calib_dir):
+        """
+        Builds a TensorRT INT8 version of the model, calibrated on the most recent game states in calib_dir,
+        and writes the resulting graph to engine_path.
+
+        :param str engine_path: path to write the serialized TensorRT graph to, or None to not write it
+        :param str calib_dir: directory containing the play data to calibrate with
+        :return FrozenGraphPredictor: predictor running the TensorRT graph, or None if there was no play
+            data to calibrate with
+        """
+        calibration_data = read_input_planes(calib_dir, self.config.model.trt_calibration_size)
+        if len(calibration_data) == 0:
+            logger.debug(f"no play data to calibrate with in {calib_dir}")
+            return None
+        with self._isolated_copy() as copy:
+            graph_def = build_trt_int8_graph(copy._fused_model(), calibration_data,
+                                             self.config.model.api_max_batch_size)
+        if engine_path:
+            logger.debug(f"save TensorRT graph to {engine_path}")
+            with open(engine_path, "wb") as f:
+                f.write(graph_def.SerializeToString())
+        return FrozenGraphPredictor(graph_def, FROZEN_INPUT_NAME, FROZEN_OUTPUT_NAMES)
+
+    def frozen_path(self, weight_path):
+        """
+        :param str weight_path: path to the file containing the model weights
+        :return str: path to save the frozen prediction graph for those weights to. It names the inference
+            settings the graph is built with, so a graph built with other settings is never picked up.
+        """
+        mc = self.config.model
+        dtype = "float16" if mc.fp16_inference else "float32"
+        return os.path.splitext(weight_path)[0] + f"_frozen_{mc.inference_data_format}_{dtype}.pb"
+
     @staticmethod
     def fetch_digest(weight_path):
         if os.path.exists(weight_path):
-            m = hashlib.sha256()
             with open(weight_path, "rb") as f:
-                m.update(f.read())
-            return m.hexdigest()
+                if hasattr(hashlib, "file_digest"):  # python 3.11+
+                    return hashlib.file_digest(f, "sha256").hexdigest()
+                m = hashlib.sha256()
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    m.update(chunk)
+                return m.hexdigest()
 
+    def _has_layers_of(self, model_config):
+        """
+        :param dict model_config: config of a saved model, as returned by Model.get_config
+        :return: true iff self.model has the same layers, by name, as the saved model. Types are not compared
+            so that a Conv2D and a FakeQuantConv2D can load each other's weights. Input layers are skipped
+            since keras names them by how many have been built so far.
+        """
+        saved = [layer["config"]["name"] for layer in model_config["layers"] if layer["class_name"] != "InputLayer"]
+        built = [layer.name for layer in self.model.layers if not isinstance(layer, InputLayer)]
+        return saved == built
+
+    @_in_own_session
     def load(self, config_path, weight_path):
         """
+        Loads the weights into a model built from self.config, at the residual block width of the saved
+        model, falling back to rebuilding the model from the saved configuration if its layers differ.
+        Building directly is much faster than going through Model.from_config.
 
         :param str config_path: path to the file containing the entire configuration
         :param str weight_path: path to the file containing the model weights
@@ -134,24 +418,40 @@ class ChessModel:
                                             resources.model_best_distributed_ftp_user,
                                             resources.model_best_distributed_ftp_password)
                 ftp_connection.cwd(resources.model_best_distributed_ftp_remote_path)
-                ftp_connection.retrbinary("RETR model_best_config.json", open(config_path, 'wb').write)
-                ftp_connection.retrbinary("RETR model_best_weight.h5", open(weight_path, 'wb').write)
+                with open(config_path, 'wb') as fh:
+                    ftp_connection.retrbinary("RETR model_best_config.json", fh.write, blocksize=FTP_BLOCK_SIZE)
+                with open(weight_path, 'wb') as fh:
+                    ftp_connection.retrbinary("RETR model_best_weight.h5", fh.write, blocksize=FTP_BLOCK_SIZE)
                 ftp_connection.quit()
             except:
                 pass
         if os.path.exists(config_path) and os.path.exists(weight_path):
             logger.debug(f"loading model from {config_path}")
             with open(config_path, "rt") as f:
-                self.model = Model.from_config(json.load(f))
-            self.model.load_weights(weight_path)
-            self.model._make_predict_function()
+                model_config = json.load(f)
+            inner_filter_num = self._inner_filter_num([layer["config"] for layer in model_config["layers"]])
+            if self.model is None or \
+                    self._inner_filter_num([layer.get_config() for layer in self.model.layers]) != inner_filter_num:
+                self.build(inner_filter_num)
+            try:
+                if not self._has_layers_of(model_config):
+                    raise ValueError("saved model has different layers")
+                self.model.load_weights(weight_path, by_name=True)
+            except ValueError as e:
+                logger.debug(f"rebuilding model from {config_path}: {e}")
+                self.model = Model.from_config(model_config, custom_objects=CUSTOM_OBJECTS)
+                self.model.load_weights(weight_path)
+            self.weight_path = weight_path
             self.digest = self.fetch_digest(weight_path)
             logger.debug(f"loaded model digest = {self.digest}")
+            if self.api is not None:
+                self._build_inference_model()
             return True
         else:
             logger.debug(f"model files does not exist at {config_path} and {weight_path}")
             return False
 
+    @_in_own_session
     def save(self, config_path, weight_path):
         """
 
@@ -162,6 +462,9 @@ class ChessModel:
         with open(config_path, "wt") as f:
             json.dump(self.model.get_config(), f)
             self.model.save_weights(weight_path)
+        if self.config.model.frozen_inference:
+            self._write_frozen_model(self.frozen_path(weight_path))
+        self.weight_path = weight_path
         self.digest = self.fetch_digest(weight_path)
         logger.debug(f"saved model digest {self.digest}")
 
@@ -174,13 +477,10 @@ class ChessModel:
                                             resources.model_best_distributed_ftp_user,
                                             resources.model_best_distributed_ftp_password)
                 ftp_connection.cwd(resources.model_best_distributed_ftp_remote_path)
-                fh = open(config_path, 'rb')
-                ftp_connection.storbinary('STOR model_best_config.json', fh)
-                fh.close()
-
-                fh = open(weight_path, 'rb')
-                ftp_connection.storbinary('STOR model_best_weight.h5', fh)
-                fh.close()
+                with open(config_path, 'rb') as fh:
+                    ftp_connection.storbinary('STOR model_best_config.json', fh, blocksize=FTP_BLOCK_SIZE)
+                with open(weight_path, 'rb') as fh:
+                    ftp_connection.storbinary('STOR model_best_weight.h5', fh, blocksize=FTP_BLOCK_SIZE)
                 ftp_connection.quit()
             except:
                 pass
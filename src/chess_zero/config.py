@@ -48,6 +48,7 @@ class ResourceConfig:
         self.model_dir = os.environ.get("MODEL_DIR", os.path.join(self.data_dir, "model"))
         self.model_best_config_path = os.path.join(self.model_dir, "model_best_config.json")
         self.model_best_weight_path = os.path.join(self.model_dir, "model_best_weight.h5")
+        self.model_trt_int8_path_tmpl = os.path.join(self.model_dir, "model_trt_int8_%s.pb")  # % digest and settings
 
         self.model_best_distributed_ftp_server = "alpha-chess-zero.mygamesonline.org"
         self.model_best_distributed_ftp_user = "2537576_chess"
@@ -55,6 +55,7 @@ class TrainerConfig:
         self.save_model_steps = 25
         self.load_data_steps = 100
         self.loss_weights = [1.25, 1.0] # [policy, value] prevent value overfit in SL
+        self.residual_keep_ratio = 1.0 # below 1, prunes the residual blocks to this fraction of cnn_filter_num channels before training
 
 
 class ModelConfig:
@@ -63,6 +64,17 @@ class ModelConfig:
     cnn_filter_size = 3
     res_layer_num = 7
     l2_reg = 1e-4
+    training = True # builds without l2 regularization when false, set by the manager for workers that only predict
     value_fc_size = 256
+    quantize_residual = False # fake quantize the residual convs to INT8 while training, the heads stay in float
     distributed = False
     input_depth = 18
+    data_format = "channels_first" # channels_last transposes the (18, 8, 8) input planes inside the model
+    inference_data_format = "channels_first"
+    xla_jit = False # compile the keras session with XLA, fusing each residual block's ops into fewer kernels
+    api_max_batch_size = 64
+    api_batch_timeout = 0.001 # seconds to wait for more observations to fill a prediction batch
+    fp16_inference = False # predict with a float16 copy of the model
+    frozen_inference = False # save a frozen prediction graph next to the weights, and predict with it when loading them
+    trt_int8_inference = False # predict with a TensorRT INT8 engine, calibrated on recent play data
+    trt_calibration_size = 512
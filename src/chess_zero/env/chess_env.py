@@ -21,7 +21,11 @@ castling_order = 'KQkq'       # 4x8x8
 # fifty-move-rule             # 1x8x8
 # en en_passant               # 1x8x8
 
-ind = {pieces_order[i]: i for i in range(12)}
+# maps each byte of a board from replace_tags_board to its plane in pieces_order, 12 meaning an empty square
+piece_plane_lut = np.full(256, 12, dtype=np.int8)
+piece_plane_lut[[ord(p) for p in pieces_order]] = np.arange(12)
+# row i is the one-hot encoding of a square holding the piece of plane i, the last row (empty square) is all zeros
+square_planes_lut = np.eye(13, 12, dtype=np.float32)
 
 
 class ChessEnv:
@@ -321,13 +325,8 @@ def coord_to_alg(coord):
 
 
 def to_planes(fen):
-    board_state = replace_tags_board(fen)
-    pieces_both = np.zeros(shape=(12, 8, 8), dtype=np.float32)
-    for rank in range(8):
-        for file in range(8):
-            v = board_state[rank * 8 + file]
-            if v.isalpha():
-                pieces_both[ind[v]][rank][file] = 1
+    board_state = np.frombuffer(replace_tags_board(fen).encode("ascii"), dtype=np.uint8)
+    pieces_both = square_planes_lut[piece_plane_lut[board_state]].T.reshape((12, 8, 8))
     assert pieces_both.shape == (12, 8, 8)
     return pieces_both
 
@@ -9,8 +9,10 @@ from glob import glob
 from logging import getLogger
 
 import chess
+import numpy as np
 import pyperclip
 from chess_zero.config import ResourceConfig
+from chess_zero.env.chess_env import canon_input_planes
 
 logger = getLogger(__name__)
 
@@ -38,6 +40,23 @@ def get_game_data_filenames(rc: ResourceConfig):
     return files
 
 
+def read_input_planes(directory, num):
+    """
+    Reads the observed game states from the most recent play data files in the directory
+
+    :param str directory: directory containing the play data
+    :param int num: maximum number of states to read
+    :return np.ndarray: (n, 18, 8, 8) array of the states, as input planes for the model
+    """
+    planes = []
+    for filename in sorted(glob(os.path.join(directory, "play_*.json")), reverse=True):
+        data = read_game_data_from_file(filename) or []
+        planes.extend(canon_input_planes(state_fen) for state_fen, policy, value in data[:num - len(planes)])
+        if len(planes) >= num:
+            break
+    return np.asarray(planes, dtype=np.float32)
+
+
 def get_next_generation_model_dirs(rc: ResourceConfig):
     dir_pattern = os.path.join(rc.next_generation_model_dir, rc.next_generation_model_dirname_tmpl % "*")
     dirs = list(sorted(glob(dir_pattern)))
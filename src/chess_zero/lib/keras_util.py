@@ -0,0 +1,259 @@
+"""
+For rewriting trained Keras models into equivalent graphs which are cheaper to run predictions with
+"""
+
+from collections import defaultdict
+
+import numpy as np
+
+
+def fuse_batchnorm(model):
+    """
+    Builds a copy of the model in which every Conv2D whose only consumer is a BatchNormalization over its
+    channel axis has that normalization folded into its kernel and bias. At inference time batch norm is just
+    a fixed per-channel affine transform, so the fused copy gives the same predictions with one less op per
+    conv. The original model is left untouched, so it can still be trained and saved. Subclasses of Conv2D,
+    like the fake quantized convs of quantization aware training, only change how training sees the kernel,
+    so they are fused and copied as plain Conv2D.
+
+    :param keras.engine.training.Model model: model to fuse
+    :return keras.engine.training.Model: the fused copy
+    """
+    from keras.layers.convolutional import Conv2D
+    from keras.layers.normalization import BatchNormalization
+
+    consumers = _consumers(model)
+    folds = {}  # conv name -> batchnorm layer folded into it
+    for layer in model.layers:
+        if not isinstance(layer, Conv2D):
+            continue
+        following = consumers[layer.output.name]
+        if len(following) != 1 or not isinstance(following[0], BatchNormalization):
+            continue
+        bn = following[0]
+        channel_axis = 1 if layer.data_format == "channels_first" else 3
+        if bn.axis % 4 == channel_axis:
+            folds[layer.name] = bn
+    folded = {bn.name for bn in folds.values()}
+
+    def fold(layer, config, weights):
+        if layer.name in folded:
+            return None
+        if layer.name in folds:
+            config["use_bias"] = True
+            weights = _fold_batchnorm_weights(weights, folds[layer.name])
+        if isinstance(layer, Conv2D):
+            return config, weights, Conv2D
+        return config, weights
+
+    return _rebuild(model, fold)
+
+
+def prune_inner_channels(model, num_channels):
+    """
+    Builds a copy of the model in which each Conv2D followed only by a BatchNormalization, an Activation and
+    another Conv2D (the first conv of every residual block) keeps only its most important output channels.
+    Channel importance is the L1 norm of the channel's kernel times the scale its batch norm applies to it.
+    The pruned channels are also cut from the batch norm and from the input of the next conv, so the copy is
+    a plain dense model, just narrower. Convs whose output feeds a residual add are left alone, since every
+    block would have to drop the same channels. The copy should be fine-tuned to recover from the pruning.
+    Pruned convs whose name ends with their filter count, like "res1_conv1-3-256", are renamed to the new
+    count, so the copy matches a model built at that width.
+
+    :param keras.engine.training.Model model: model to prune
+    :param int num_channels: number of channels to keep in each pruned conv
+    :return keras.engine.training.Model: the pruned copy
+    """
+    from keras.layers.convolutional import Conv2D
+    from keras.layers.core import Activation
+    from keras.layers.normalization import BatchNormalization
+
+    consumers = _consumers(model)
+
+    def only_consumer(layer):
+        following = consumers[layer.output.name]
+        return following[0] if len(following) == 1 else None
+
+    output_keep, input_keep = {}, {}  # layer name -> indices of the channels kept in its output / input
+    for conv in model.layers:
+        if not isinstance(conv, Conv2D):
+            continue
+        bn = only_consumer(conv)
+        act = only_consumer(bn) if isinstance(bn, BatchNormalization) else None
+        next_conv = only_consumer(act) if isinstance(act, Activation) else None
+        if not isinstance(next_conv, Conv2D):
+            continue
+        bn_weights = bn.get_weights()
+        gamma = bn_weights[0] if bn.scale else 1
+        bn_scale = np.abs(gamma / np.sqrt(bn_weights[-1] + bn.epsilon))
+        importance = np.abs(conv.get_weights()[0]).sum(axis=(0, 1, 2)) * bn_scale
+        keep = np.sort(np.argsort(-importance)[:num_channels])
+        output_keep[conv.name] = output_keep[bn.name] = keep
+        input_keep[next_conv.name] = keep
+
+    def prune(layer, config, weights):
+        if layer.name in output_keep:
+            keep = output_keep[layer.name]
+            if isinstance(layer, Conv2D):
+                suffix = "-" + str(layer.filters)
+                if config["name"].endswith(suffix):
+                    config["name"] = config["name"][:-len(suffix)] + "-" + str(len(keep))
+                config["filters"] = len(keep)
+                weights = [weights[0][..., keep]] + [w[keep] for w in weights[1:]]
+            else:
+                weights = [w[keep] for w in weights]
+        if layer.name in input_keep:
+            weights = [weights[0][:, :, input_keep[layer.name], :]] + weights[1:]
+        return config, weights
+
+    return _rebuild(model, prune)
+
+
+def cast_model(model, dtype, keep_float32=()):
+    """
+    Builds a copy of the model whose weights and activations use the given float dtype, except for the
+    layers named in keep_float32, which stay in float32 and get their input cast back up to it. Keras has no
+    per-layer dtype, so this is done by switching floatx while each layer's copy is built.
+
+    :param keras.engine.training.Model model: model to cast
+    :param str dtype: float dtype to use, like "float16"
+    :param keep_float32: names of the layers to leave in float32, like output layers whose sums of many small
+        terms would lose too much precision in float16
+    :return keras.engine.training.Model: the cast copy
+    """
+    import keras.backend as k
+
+    def cast(layer, config, weights):
+        if layer.name in keep_float32:
+            return config, weights
+        return config, [w.astype(dtype) for w in weights]
+
+    floatx = k.floatx()
+    k.set_floatx(dtype)
+    try:
+        return _rebuild(model, cast, dtype_of=lambda layer: "float32" if layer.name in keep_float32 else dtype)
+    finally:
+        k.set_floatx(floatx)
+
+
+def to_channels_last(model):
+    """
+    Builds a copy of a channels_first model which runs in channels_last, with a transpose of the input
+    added right after the input layer so that it is still fed (channels, height, width) planes. Keras keeps
+    conv kernels as (height, width, in, out) in both formats, so only the dense layers reading a flattened
+    feature map need their weights permuted.
+
+    :param keras.engine.training.Model model: model to convert
+    :return keras.engine.training.Model: the converted copy, or model itself if it has no channels_first layers
+    """
+    from keras.layers.core import Dense, Flatten, Permute
+
+    if not any(layer.get_config().get("data_format") == "channels_first" for layer in model.layers):
+        return model
+    producers = {layer.output.name: layer for layer in model.layers}
+
+    def convert(layer, config, weights):
+        if config.get("data_format") == "channels_first":
+            config["data_format"] = "channels_last"
+        if "axis" in config and config["axis"] in (1, -3):  # batch norms, concatenations, channel slices
+            config["axis"] = -1
+        producer = producers[layer.input.name] if isinstance(layer, Dense) else None
+        if isinstance(producer, Flatten) and len(producer.input_shape) == 4:
+            channels, height, width = producer.input_shape[1:]
+            order = np.arange(channels * height * width).reshape((channels, height, width)).transpose((1, 2, 0))
+            weights = [weights[0][order.flatten()]] + weights[1:]
+        return config, weights
+
+    return _rebuild(model, convert, on_input=lambda x: Permute((2, 3, 1), name="input_transpose")(x))
+
+
+def cast_to(x, dtype):
+    """
+    For use in a Lambda layer, to cast a tensor to another dtype.
+
+    :param x: tensor to cast
+    :param str dtype: dtype to cast to
+    :return: x cast to dtype
+    """
+    import keras.backend as k
+
+    return k.cast(x, dtype)
+
+
+def _fold_batchnorm_weights(conv_weights, bn):
+    kernel = conv_weights[0]
+    bias = conv_weights[1] if len(conv_weights) > 1 else np.zeros(kernel.shape[-1], dtype=kernel.dtype)
+    bn_weights = list(bn.get_weights())
+    gamma = bn_weights.pop(0) if bn.scale else np.ones_like(bias)
+    beta = bn_weights.pop(0) if bn.center else np.zeros_like(bias)
+    mean, var = bn_weights
+    scale = gamma / np.sqrt(var + bn.epsilon)
+    # keras stores conv kernels as (height, width, in, out) whatever the data_format, so scale the last axis
+    return [kernel * scale, (bias - mean) * scale + beta]
+
+
+def _consumers(model):
+    """
+    :return defaultdict(list): maps the name of each tensor in the model to the layers that take it as input
+    """
+    from keras.engine.topology import InputLayer
+
+    consumers = defaultdict(list)
+    for layer in model.layers:
+        if isinstance(layer, InputLayer):
+            continue
+        for t in _as_list(layer.input):
+            consumers[t.name].append(layer)
+    return consumers
+
+
+def _rebuild(model, rewrite, on_input=None, dtype_of=None):
+    """
+    Builds a new model with the same topology as model, made from fresh copies of each of its layers.
+
+    :param keras.engine.training.Model model: model to copy. Every layer must have a single inbound node,
+        which holds for everything built by ChessModel.
+    :param rewrite: called as rewrite(layer, config, weights) for every non-input layer, returning the
+        (config, weights) to build the copy from, or (config, weights, layer class) to build it as another
+        class, or None to drop the layer and pass its input straight through
+    :param on_input: if given, called on each new input tensor to add layers between it and the rest of the model
+    :param dtype_of: if given, called on every non-input layer to get the floatx to build its copy with. Inputs
+        of a different dtype are cast to it first.
+    :return keras.engine.training.Model: the new model
+    """
+    import keras.backend as k
+    from keras.engine.topology import Input, InputLayer
+    from keras.engine.training import Model
+    from keras.layers.core import Lambda
+
+    new_inputs, tensors = {}, {}
+    for layer in model.layers:
+        if isinstance(layer, InputLayer):
+            x = new_inputs[layer.output.name] = Input(batch_shape=layer.batch_input_shape, name=layer.name)
+            tensors[layer.output.name] = on_input(x) if on_input else x
+            continue
+        layer_inputs = [tensors[t.name] for t in _as_list(layer.input)]
+        rewritten = rewrite(layer, layer.get_config(), layer.get_weights())
+        if rewritten is None:
+            tensors[layer.output.name] = layer_inputs if len(layer_inputs) > 1 else layer_inputs[0]
+            continue
+        config, weights, cls = rewritten if len(rewritten) == 3 else rewritten + (layer.__class__,)
+        floatx = k.floatx()
+        if dtype_of:
+            k.set_floatx(dtype_of(layer))
+            layer_inputs = [x if k.dtype(x) == k.floatx() else
+                            Lambda(cast_to, arguments={"dtype": k.floatx()}, name=layer.name + "_cast")(x)
+                            for x in layer_inputs]
+        try:
+            clone = cls.from_config(config)
+            tensors[layer.output.name] = clone(layer_inputs if len(layer_inputs) > 1 else layer_inputs[0])
+            clone.set_weights(weights)
+        finally:
+            k.set_floatx(floatx)
+
+    return Model([new_inputs[t.name] for t in model.inputs], [tensors[t.name] for t in model.outputs],
+                 name=model.name)
+
+
+def _as_list(x):
+    return x if isinstance(x, list) else [x]
@@ -1,18 +1,24 @@
 """
 For helping to configure tensorflow
 """
+from contextlib import contextmanager
 
+_session_config = None  # the tf.ConfigProto set_session_config gave keras' session, for new_session to reuse
 
-def set_session_config(per_process_gpu_memory_fraction=None, allow_growth=None):
+
+def set_session_config(per_process_gpu_memory_fraction=None, allow_growth=None, xla_jit=False):
     """
 
     :param allow_growth: When necessary, reserve memory
     :param float per_process_gpu_memory_fraction: specify GPU memory usage as 0 to 1
+    :param bool xla_jit: compile the graph with XLA, which fuses chains of ops such as the conv, batch norm,
+        add and relu of a residual block into single kernels
 
     :return:
     """
     import tensorflow as tf
     import keras.backend as k
+    global _session_config
 
     config = tf.ConfigProto(
         gpu_options=tf.GPUOptions(
@@ -20,5 +26,188 @@ def set_session_config(per_process_gpu_memory_fraction=None, allow_growth=None):
             allow_growth=allow_growth,
         )
     )
+    if xla_jit:
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    _session_config = config
     sess = tf.Session(config=config)
     k.set_session(sess)
+
+
+def new_session(graph=None):
+    """
+    :param tf.Graph graph: graph to run, by default the current default graph
+    :return tf.Session: new session on graph, configured like keras' own session by set_session_config
+    """
+    import tensorflow as tf
+
+    return tf.Session(graph=graph, config=_session_config)
+
+
+@contextmanager
+def isolated_session():
+    """
+    Makes a new graph and session the defaults of the calling thread for the duration of the block. Keras
+    uses the thread's default session ahead of its own, so models built in the block do not add any ops to
+    the main graph, and are freed along with their graph once nothing refers to them anymore. Other threads,
+    like the api's, keep predicting with the main session meanwhile.
+
+    :return tf.Session: the new session
+    """
+    import tensorflow as tf
+
+    with tf.Graph().as_default(), new_session() as sess:
+        yield sess
+
+
+@contextmanager
+def session_scope(session):
+    """
+    Makes a session and its graph the calling thread's defaults for the duration of the block, so keras
+    builds and runs models in them.
+
+    :param tf.Session session: session to use, or None to leave the defaults as they are
+    """
+    if session is None:
+        yield
+        return
+    with session.graph.as_default(), session.as_default():
+        yield
+
+
+def freeze_model(model):
+    """
+    Converts the graph of a Keras model into a GraphDef with all of its variables replaced by constants.
+    Only the ops the model's outputs depend on are kept, but the whole graph gets serialized on the way, so
+    models to freeze are best built in an isolated_session.
+
+    :param keras.engine.training.Model model: model to freeze
+    :return tf.GraphDef: the frozen graph
+    """
+    import tensorflow as tf
+    import keras.backend as k
+
+    sess = k.get_session()
+    output_names = [t.op.name for t in model.outputs]
+    graph_def = tf.graph_util.extract_sub_graph(model.outputs[0].graph.as_graph_def(), output_names)
+    return tf.graph_util.convert_variables_to_constants(sess, graph_def, output_names)
+
+
+FROZEN_INPUT_NAME = "planes"
+FROZEN_OUTPUT_NAMES = ["policy", "value"]
+
+
+def frozen_graph_def(model):
+    """
+    Freezes a Keras model, with its input and outputs renamed to FROZEN_INPUT_NAME and FROZEN_OUTPUT_NAMES so
+    that it can be run without knowing how keras named them.
+
+    :param keras.engine.training.Model model: model to freeze
+    :return tf.GraphDef: the frozen graph
+    """
+    return _with_frozen_names(freeze_model(model), model)
+
+
+def write_frozen_model(model, path):
+    """
+    Freezes a Keras model as by frozen_graph_def and writes it to path.
+
+    :param keras.engine.training.Model model: model to write
+    :param str path: path to write the GraphDef to
+    """
+    with open(path, "wb") as f:
+        f.write(frozen_graph_def(model).SerializeToString())
+
+
+def build_trt_int8_graph(model, calibration_data, max_batch_size, batch_size=64):
+    """
+    Builds a TensorRT INT8 version of a Keras model, using TF-TRT. The quantization ranges are picked by
+    TensorRT's entropy calibration, from running the calibration data through the graph.
+
+    :param keras.engine.training.Model model: model to convert
+    :param np.ndarray calibration_data: inputs representative of what the model will be asked to predict
+    :param int max_batch_size: largest batch the TensorRT engine will be run with
+    :param int batch_size: batch size to run the calibration data with, if no more than max_batch_size
+    :return tf.GraphDef: graph in which the supported parts of the model run as INT8 TensorRT engines, with
+        its input and outputs named like write_frozen_model's, so it can be loaded by FrozenGraphPredictor.load
+    """
+    from tensorflow.contrib import tensorrt as trt
+
+    input_name = model.input.op.name
+    output_names = [t.op.name for t in model.outputs]
+    calib_graph = trt.create_inference_graph(input_graph_def=freeze_model(model), outputs=output_names,
+                                             max_batch_size=max_batch_size, max_workspace_size_bytes=1 << 30,
+                                             precision_mode="INT8")
+    predictor = FrozenGraphPredictor(calib_graph, input_name, output_names)
+    batch_size = min(batch_size, max_batch_size)
+    for i in range(0, len(calibration_data), batch_size):
+        predictor.predict_on_batch(calibration_data[i:i + batch_size])
+    predictor.close()
+    return _with_frozen_names(trt.calib_graph_to_infer_graph(calib_graph), model)
+
+
+def _with_frozen_names(graph_def, model):
+    """
+    :param tf.GraphDef graph_def: frozen graph of model
+    :param keras.engine.training.Model model: model the graph was frozen from
+    :return tf.GraphDef: the graph, with its input and outputs renamed to FROZEN_INPUT_NAME and
+        FROZEN_OUTPUT_NAMES
+    """
+    import tensorflow as tf
+
+    with tf.Graph().as_default() as graph:
+        planes = tf.placeholder(model.input.dtype, shape=model.input.shape, name=FROZEN_INPUT_NAME)
+        outputs = tf.import_graph_def(graph_def, input_map={model.input.name: planes}, name="",
+                                      return_elements=[t.name for t in model.outputs])
+        for output, name in zip(outputs, FROZEN_OUTPUT_NAMES):
+            tf.identity(output, name=name)
+    return graph.as_graph_def()
+
+
+class FrozenGraphPredictor:
+    """
+    Makes predictions with a frozen graph in its own graph and session, standing in for a Keras model's
+    predict_on_batch.
+
+    Attributes:
+        :ivar tf.Graph graph: graph the frozen graph was imported into
+        :ivar tf.Tensor input: input placeholder of the graph
+        :ivar list(tf.Tensor) outputs: output tensors of the graph
+        :ivar tf.Session session: session to run the graph in
+    """
+    def __init__(self, graph_def, input_name, output_names):
+        """
+        :param tf.GraphDef graph_def: frozen graph to run
+        :param str input_name: name of the input op
+        :param list(str) output_names: names of the output ops
+        """
+        import tensorflow as tf
+        try:
+            import tensorflow.contrib.tensorrt  # noqa: F401 registers the TRTEngineOp
+        except ImportError:
+            pass
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tensors = tf.import_graph_def(graph_def, name="",
+                                          return_elements=[n + ":0" for n in [input_name] + output_names])
+        self.input, self.outputs = tensors[0], tensors[1:]
+        self.session = new_session(self.graph)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param str path: path a model was written to by write_frozen_model
+        :return FrozenGraphPredictor: predictor running that model
+        """
+        import tensorflow as tf
+
+        graph_def = tf.GraphDef()
+        with open(path, "rb") as f:
+            graph_def.ParseFromString(f.read())
+        return cls(graph_def, FROZEN_INPUT_NAME, FROZEN_OUTPUT_NAMES)
+
+    def predict_on_batch(self, data):
+        return self.session.run(self.outputs, feed_dict={self.input: data})
+
+    def close(self):
+        self.session.close()
@@ -24,6 +24,7 @@ def create_parser():
     parser.add_argument("--new", help="run from new best model", action="store_true")
     parser.add_argument("--type", help="use normal setting", default="mini")
     parser.add_argument("--total-step", help="set TrainerConfig.start_total_steps", type=int)
+    parser.add_argument("--prune", help="set TrainerConfig.residual_keep_ratio", type=float)
     return parser
 
 
@@ -35,10 +36,16 @@ def setup(config: Config, args):
     :param ArgumentParser args: args to use to control config.
     """
     config.opts.new = args.new
+    config.model.training = args.cmd == 'opt'
     if args.total_step is not None:
         config.trainer.start_total_steps = args.total_step
+    if args.prune is not None:
+        config.trainer.residual_keep_ratio = args.prune
     config.resource.create_directories()
     setup_logger(config.resource.main_log_path)
+    if config.model.xla_jit:
+        from .lib.tf_util import set_session_config
+        set_session_config(xla_jit=True)
 
 
 def start():
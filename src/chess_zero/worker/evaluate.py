@@ -51,22 +51,25 @@ class EvaluateWorker:
         while True:
             ng_model, model_dir = self.load_next_generation_model()
             logger.debug(f"start evaluate model {model_dir}")
-            ng_is_great = self.evaluate_model(ng_model)
+            ng_pipes = self.m.list([ng_model.get_pipes(self.play_config.search_threads) for _ in range(self.play_config.max_processes)])
+            ng_is_great = self.evaluate_model(ng_pipes)
             if ng_is_great:
                 logger.debug(f"New Model become best model: {model_dir}")
                 save_as_best_model(ng_model)
-                self.current_model = ng_model
+                self.current_model.close()
+                self.current_model, self.cur_pipes = ng_model, ng_pipes
+            else:
+                ng_model.close()
             self.move_model(model_dir)
 
-    def evaluate_model(self, ng_model):
+    def evaluate_model(self, ng_pipes):
         """
-        Given a model, evaluates it by playing a bunch of games against the current model.
+        Given the pipes of a model, evaluates it by playing a bunch of games against the current model.
 
-        :param ChessModel ng_model: model to evaluate
+        :param list(list(Connection)) ng_pipes: pipes on which the model to evaluate is listening, one list
+            per process
         :return: true iff this model is better than the current_model
         """
-        ng_pipes = self.m.list([ng_model.get_pipes(self.play_config.search_threads) for _ in range(self.play_config.max_processes)])
-
         futures = []
         with ProcessPoolExecutor(max_workers=self.play_config.max_processes) as executor:
             for game_idx in range(self.config.eval.game_num):
@@ -116,7 +119,7 @@ class EvaluateWorker:
         Loads the best model from the standard directory.
         :return ChessModel: the model
         """
-        model = ChessModel(self.config)
+        model = ChessModel(self.config, isolated=True)  # so it can be freed once replaced
         load_best_model_weight(model)
         return model
 
@@ -135,7 +138,7 @@ class EvaluateWorker:
         model_dir = dirs[-1] if self.config.eval.evaluate_latest_first else dirs[0]
         config_path = os.path.join(model_dir, rc.next_generation_model_config_filename)
         weight_path = os.path.join(model_dir, rc.next_generation_model_weight_filename)
-        model = ChessModel(self.config)
+        model = ChessModel(self.config, isolated=True)  # so it can be freed once evaluated
         model.load(config_path, weight_path)
         return model, model_dir
 
@@ -166,6 +166,8 @@ class OptimizeWorker:
             config_path = os.path.join(latest_dir, rc.next_generation_model_config_filename)
             weight_path = os.path.join(latest_dir, rc.next_generation_model_weight_filename)
             model.load(config_path, weight_path)
+        if self.config.trainer.residual_keep_ratio < 1:
+            model.prune_residual_blocks(self.config.trainer.residual_keep_ratio)
         return model
 
 